@@ -20,6 +20,7 @@ from __future__ import annotations
 
 from abc import abstractmethod
 from dataclasses import dataclass, field
+from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
 import torch
@@ -285,6 +286,15 @@ class VanillaDataManagerConfig(InstantiateConfig):
     """The scale factor for scaling spatial data such as images, mask, semantics
     along with relevant information about camera intrinsics
     """
+    dataset_cache_dir: Optional[Path] = None
+    """Directory where datasets may cache values derived from the input files (e.g. the image size scan),
+    so they are not recomputed on subsequent runs. If None, nothing is cached on disk."""
+    dataset_persistent_cache: bool = False
+    """Whether to store decoded depth, normal and mask images in `dataset_cache_dir` and memory-map them instead of
+    decoding the source files every epoch."""
+    dataset_decode_jpeg_on_gpu: bool = False
+    """Whether to decode JPEG images on the GPU with nvjpeg (if available) instead of PIL. This is faster, but the
+    decoded pixels can differ slightly from the ones of PIL."""
 
 
 class VanillaDataManager(DataManager):  # pylint: disable=abstract-method
@@ -335,6 +345,11 @@ class VanillaDataManager(DataManager):  # pylint: disable=abstract-method
         return GeneralizedDataset(
             dataparser_outputs=self.train_dataparser_outputs,
             scale_factor=self.config.camera_res_scale_factor,
+            cache_dir=self.config.dataset_cache_dir,
+            # the train dataloader keeps all images itself in that case, a sample cache would only duplicate them
+            cache_size=0 if self.config.train_num_images_to_sample_from == -1 else None,
+            persistent_cache=self.config.dataset_persistent_cache,
+            decode_jpeg_on_gpu=self.config.dataset_decode_jpeg_on_gpu,
         )
 
     def create_eval_dataset(self) -> InputDataset:
@@ -342,6 +357,9 @@ class VanillaDataManager(DataManager):  # pylint: disable=abstract-method
         return GeneralizedDataset(
             dataparser_outputs=self.dataparser.get_dataparser_outputs(split=self.test_split),
             scale_factor=self.config.camera_res_scale_factor,
+            cache_dir=self.config.dataset_cache_dir,
+            persistent_cache=self.config.dataset_persistent_cache,
+            decode_jpeg_on_gpu=self.config.dataset_decode_jpeg_on_gpu,
         )
 
     def _get_pixel_sampler(  # pylint: disable=no-self-use
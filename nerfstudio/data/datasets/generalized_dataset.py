@@ -17,9 +17,14 @@ Dataset.
 """
 from __future__ import annotations
 
+import concurrent.futures
+import hashlib
+import os
+import threading
+from collections import OrderedDict
 from copy import deepcopy
 from pathlib import Path
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional, Tuple
 
 import numpy as np
 import numpy.typing as npt
@@ -28,12 +33,168 @@ from PIL import Image
 from rich.progress import Console, track
 from torch.utils.data import Dataset
 from torchtyping import TensorType
+from torchvision.io import ImageReadMode, decode_jpeg, read_file
 
 from nerfstudio.data.dataparsers.base_dataparser import DataparserOutputs
 from nerfstudio.data.datasets.base_dataset import InputDataset
 from nerfstudio.data.utils.data_utils import get_image_mask_tensor_from_path, get_depth_image_from_path, \
-    get_normal_image_from_path
+    get_normal_image_from_path, get_mask_indices, quantize_normal_image
+from nerfstudio.data.utils.nerfstudio_collate import nerfstudio_collate
 from nerfstudio.utils.images import BasicImages
+from nerfstudio.utils.io import load_from_json, write_to_json
+
+CONSOLE = Console(width=120)
+
+# Lower case fragments of the errors torchvision raises for JPEGs nvjpeg cannot decode, such as CMYK or some
+# progressive JPEGs. Other errors (e.g. CUDA errors) are not caught by the PIL fallback.
+JPEG_DECODE_ERROR_PATTERNS = ("nvjpeg", "not supported", "unsupported", "decod")
+# Number of threads used for I/O bound work such as reading image headers or loading samples.
+NUM_IO_THREADS = 16
+# Keys holding a single (H, W, C) image per sample, which `get_collated_batch` can stack when all images have the same
+# size. Like "image", they should not be moved to the device as a whole, only the sampled pixels are.
+STACKABLE_IMAGE_KEYS = ("image", "is_gray", "depth_image", "sensor_depth", "normal_image", "fg_mask")
+# Fraction of the available system memory the per-sample data caches of all datasets may use together when no explicit
+# size is given.
+DATA_CACHE_MEMORY_FRACTION = 0.5
+
+# Bytes of the shared data cache budget that are not reserved by a dataset yet, initialized on first use.
+_data_cache_budget: Optional[int] = None
+_data_cache_budget_lock = threading.Lock()
+
+
+def _read_image_size(filename: Path) -> Tuple[int, int]:
+    """Returns the (height, width) of an image, reading only the file header."""
+    with Image.open(filename) as image:
+        width, height = image.size
+    return height, width
+
+
+def _probe_image_size(filename: Path) -> Tuple[int, int]:
+    """Returns the (height, width) of an image, reading only the file header.
+
+    Also asks the OS to read the whole file into the page cache in the background, so it is already in memory by
+    the time the image is decoded for training.
+    """
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    return _read_image_size(filename)
+
+
+def _available_memory_bytes() -> Optional[int]:
+    """Returns the currently available system memory in bytes, or None if it cannot be queried."""
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _reserve_data_cache_memory(sample_nbytes: int, max_num_samples: int) -> int:
+    """Reserves memory for the data cache of a dataset and returns how many samples it may hold.
+
+    All datasets draw from one budget, so e.g. the train and eval datasets do not both claim a fraction of the
+    available memory. Reservations are kept for the lifetime of the process.
+
+    Args:
+        sample_nbytes: Size of one sample in bytes.
+        max_num_samples: Number of samples in the dataset.
+    """
+    global _data_cache_budget  # pylint: disable=global-statement
+    with _data_cache_budget_lock:
+        if _data_cache_budget is None:
+            available_memory = _available_memory_bytes()
+            if available_memory is None:
+                return max_num_samples
+            _data_cache_budget = int(available_memory * DATA_CACHE_MEMORY_FRACTION)
+        num_samples = min(max_num_samples, _data_cache_budget // max(sample_nbytes, 1))
+        _data_cache_budget -= num_samples * sample_nbytes
+        return num_samples
+
+
+def _data_nbytes(data: Dict) -> int:
+    """Returns the number of bytes of process memory held by the tensors of a sample returned by `get_data`.
+
+    Each storage is counted once, so stride-0 views (e.g. `is_gray` or expanded gray images) are not over-counted.
+    Memory-mapped tensors of the persistent cache are backed by the page cache and not counted at all.
+    """
+    storages = {}
+    for value in data.values():
+        tensors = value.images if isinstance(value, BasicImages) else [value]
+        for tensor in tensors:
+            if isinstance(tensor, torch.Tensor) and not getattr(tensor, "is_memory_mapped", False):
+                # untyped_storage is only available from torch 2.0 on
+                storage = tensor.untyped_storage() if hasattr(tensor, "untyped_storage") else tensor.storage()
+                storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+def _decode_jpeg_on_gpu(filename: Path) -> TensorType["image_height", "image_width", "num_channels"]:
+    """Decodes a JPEG with nvjpeg and returns it as a uint8 CPU tensor of shape (H, W, 1 or 3).
+
+    Like `InputDataset.get_numpy_image`, 3 channel images with identical channels are returned as 1 channel.
+    """
+    image = decode_jpeg(read_file(str(filename)), mode=ImageReadMode.UNCHANGED, device="cuda")
+    if image.shape[0] == 3 and torch.equal(image[0], image[1]) and torch.equal(image[0], image[2]):
+        image = image[:1]
+    # only the uint8 image is copied back, the dataset outputs are expected on the CPU
+    return image.permute(1, 2, 0).cpu()
+
+
+def _depth_alignment_normal_equations(
+    depth: TensorType[..., 1], sensor_depth: TensorType[..., 1]
+) -> Tuple[TensorType[2, 2], TensorType[2, 1]]:
+    """Returns the normal equations of the least squares fit `scale * depth + offset = sensor_depth`.
+
+    Only pixels with a valid (positive) sensor depth are used. The sums are accumulated in float64, so solving the
+    2x2 system gives the same result as solving the full least squares problem.
+    """
+    mask = (sensor_depth > 0.0).squeeze(-1)
+    depth = depth[mask].double().squeeze(-1)
+    sensor = sensor_depth[mask].double().squeeze(-1)
+    num_valid = torch.tensor(float(len(depth)), dtype=torch.float64)
+    depth_sum = depth.sum()
+    lhs = torch.stack([torch.stack([(depth * depth).sum(), depth_sum]), torch.stack([depth_sum, num_valid])])
+    rhs = torch.stack([(depth * sensor).sum(), sensor.sum()])[:, None]
+    return lhs, rhs
+
+
+def _solve_depth_alignment(
+    lhs: TensorType["num_images", 2, 2], rhs: TensorType["num_images", 2, 1]
+) -> TensorType["num_images", 2]:
+    """Solves a batch of normal equations, returning the (scale, offset) of every image."""
+    # gelsd handles rank deficient systems, e.g. images without valid sensor depth
+    return torch.linalg.lstsq(lhs, rhs, driver="gelsd").solution[..., 0]
+
+
+def _is_jpeg_decode_error(error: RuntimeError) -> bool:
+    """Returns whether an error raised by `_decode_jpeg_on_gpu` means nvjpeg cannot decode the file."""
+    message = str(error).lower()
+    if "out of memory" in message:
+        return False
+    return any(pattern in message for pattern in JPEG_DECODE_ERROR_PATTERNS)
+
+
+def _hash_filenames(filenames: List[Path]) -> str:
+    """Returns a stable hash of a list of filenames, used to key on-disk caches."""
+    return hashlib.sha1("\n".join(sorted(str(f) for f in filenames)).encode("utf-8")).hexdigest()
+
+
+def _save_npy_atomic(path: Path, array: np.ndarray) -> None:
+    """Saves an array with `np.save`, going through a temporary file so concurrent readers never see partial data."""
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "wb") as file:
+        np.save(file, array)
+    os.replace(tmp_path, path)
+
+
+def _write_json_atomic(path: Path, content: Dict) -> None:
+    """Writes a JSON file through a temporary file, since every DDP rank may write the same file concurrently."""
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp.json")
+    write_to_json(tmp_path, content)
+    os.replace(tmp_path, path)
 
 
 class GeneralizedDataset(InputDataset):
@@ -46,29 +207,247 @@ class GeneralizedDataset(InputDataset):
 
     Args:
         dataparser_outputs: description of where and how to read input images.
+        scale_factor: The scaling factor for the dataparser outputs
+        cache_dir: Directory for on-disk caches (e.g. the image size scan). If None, nothing is written to disk.
+        cache_size: Maximum number of samples kept in the in-memory cache of `get_data`, 0 disables it. If None, it is
+            derived from the system memory left to the caches of all datasets once the size of the first sample is
+            known.
+        decode_jpeg_on_gpu: Whether to decode JPEG images with nvjpeg on the GPU (if available) instead of PIL. The
+            decoded pixels can differ slightly from the ones of PIL.
+        persistent_cache: Whether to store decoded depth, normal and mask images as `.npy` files in `cache_dir` and
+            memory-map them on later accesses instead of decoding the source files again.
+        dtype_depth: The dtype monocular depth images are kept in. Normal images are always kept as int8, see
+            `quantize_normal_image`. Use `dequantize_images` to convert both back to float32.
     """
 
-    def __init__(self, dataparser_outputs: DataparserOutputs, scale_factor: float = 1.0):
+    def __init__(
+        self,
+        dataparser_outputs: DataparserOutputs,
+        scale_factor: float = 1.0,
+        cache_dir: Optional[Path] = None,
+        cache_size: Optional[int] = None,
+        persistent_cache: bool = False,
+        decode_jpeg_on_gpu: bool = False,
+        dtype_depth: torch.dtype = torch.float16,
+    ):
         super().__init__(dataparser_outputs, scale_factor)
 
-        h = None
-        w = None
+        self.cache_dir = cache_dir
+        self.decode_jpeg_on_gpu = decode_jpeg_on_gpu and torch.cuda.is_available()
+        self._warned_jpeg_fallback = False
+        self.dtype_depth = dtype_depth
+        self._filenames_hash = _hash_filenames(self._dataparser_outputs.image_filenames)
+        self.all_hw_same = self._check_image_sizes()
+        self.depth_unit_scale_factor = self.metadata.get("depth_unit_scale_factor", 0.)
+
+        self.cache_size = cache_size
+        self._data_cache: OrderedDict[int, Dict] = OrderedDict()
+        self._data_cache_lock = threading.Lock()
+
+        self._persistent_cache_dir = None
+        if persistent_cache:
+            assert cache_dir is not None, "`cache_dir` must be set to use the persistent cache"
+            self._persistent_cache_dir = Path(cache_dir) / f"tensors_{self._persistent_cache_key()}"
+            self._persistent_cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self._depth_align = None
+        if "sensor_filenames" in self.metadata and "depth_filenames" in self.metadata:
+            self._depth_align = self._precompute_depth_alignment()
+
+    def _persistent_cache_key(self) -> str:
+        """Returns a hash of everything the persistently cached tensors depend on.
+
+        Besides the settings, this covers the name, size and modification time of every depth, sensor depth, normal
+        and mask file, so pointing the same scene at different priors (or updating them) does not reuse stale tensors.
+        """
+        key = hashlib.sha1(self._filenames_hash.encode("utf-8"))
+        key.update(f"{self.scale_factor}_{self.depth_unit_scale_factor}".encode("utf-8"))
+        key.update(f"{self._dataparser_outputs.dataparser_scale}_{self.dtype_depth}".encode("utf-8"))
+        key.update(self._dataparser_outputs.cameras.camera_to_worlds.cpu().numpy().tobytes())
+        source_filenames = {name: self.metadata.get(f"{name}_filenames") for name in ("depth", "sensor", "normal")}
+        source_filenames["mask"] = self._dataparser_outputs.mask_filenames
+        for name, filenames in source_filenames.items():
+            if filenames is None:
+                continue
+            key.update(name.encode("utf-8"))
+            for filename in filenames:
+                stat = os.stat(filename)
+                key.update(f"{filename}_{stat.st_size}_{stat.st_mtime_ns}".encode("utf-8"))
+        return key.hexdigest()
+
+    def _load_cached_tensor(
+        self,
+        name: str,
+        image_idx: int,
+        load_fn: Callable[[], torch.Tensor],
+        encode_fn: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+    ) -> torch.Tensor:
+        """Returns the tensor produced by `load_fn`, going through the persistent cache if it is enabled.
+
+        Args:
+            name: Name of the modality, used in the cache filename.
+            image_idx: The image index in the dataset.
+            load_fn: Decodes the tensor from its source file.
+            encode_fn: Converts the decoded tensor to the (compact) representation that is kept in memory and on disk.
+        """
+        if self._persistent_cache_dir is not None:
+            cache_path = self._persistent_cache_dir / f"{name}_{image_idx}.npy"
+            if cache_path.exists():
+                # copy-on-write mapping, so the resulting tensor is writable without touching the file
+                tensor = torch.from_numpy(np.load(cache_path, mmap_mode="c"))
+                # not resident process memory, see `_data_nbytes`
+                tensor.is_memory_mapped = True
+                return tensor
+
+        tensor = load_fn()
+        if encode_fn is not None:
+            tensor = encode_fn(tensor)
+        if self._persistent_cache_dir is not None:
+            _save_npy_atomic(cache_path, tensor.numpy())
+        return tensor
+
+    def _load_depth_image(self, image_idx: int, height: int, width: int) -> torch.Tensor:
+        """Returns the unaligned monocular depth image in float32, scaled to meter units and by the dataparser scale."""
+        depth_filepath = self.metadata["depth_filenames"][image_idx]
+        # Scale depth images to meter units and also by scaling applied to cameras
+        scale_factor = self.depth_unit_scale_factor * self._dataparser_outputs.dataparser_scale
+        return get_depth_image_from_path(filepath=depth_filepath, height=height, width=width, scale_factor=scale_factor)
+
+    def _load_aligned_depth_image(self, image_idx: int, height: int, width: int) -> torch.Tensor:
+        """Returns the monocular depth image aligned to the sensor depth (if any), converted to `dtype_depth`.
+
+        The alignment runs in full precision, only its result is rounded to `dtype_depth`.
+        """
+
+        def load_fn() -> torch.Tensor:
+            depth_image = self._load_depth_image(image_idx, height, width)
+            if self._depth_align is not None:
+                # scale * depth_pred + offset * 1 - depth_gt = 0, fitted once in `_precompute_depth_alignment`
+                scale, offset = self._depth_align[image_idx]
+                depth_image = depth_image * scale.float() + offset.float()
+            return depth_image
+
+        return self._load_cached_tensor("depth", image_idx, load_fn, encode_fn=lambda depth: depth.to(self.dtype_depth))
+
+    def _load_sensor_image(self, image_idx: int, height: int, width: int) -> torch.Tensor:
+        """Returns the sensor depth image in meter units."""
+        sensor_filepath = self.metadata["sensor_filenames"][image_idx]
+        # Scale depth images to meter units
+        scale_factor = self.depth_unit_scale_factor
+        return self._load_cached_tensor(
+            "sensor",
+            image_idx,
+            lambda: get_depth_image_from_path(
+                filepath=sensor_filepath, height=height, width=width, scale_factor=scale_factor
+            ),
+        )
+
+    def _depth_alignment_system(self, image_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the normal equations aligning the monocular depth image to the sensor depth image."""
+        height, width = _read_image_size(self._dataparser_outputs.image_filenames[image_idx])
+        if self.scale_factor != 1.0:
+            height, width = int(height * self.scale_factor), int(width * self.scale_factor)
+        depth_image = self._load_depth_image(image_idx, height, width)
+        sensor_image = self._load_sensor_image(image_idx, height, width)
+        return _depth_alignment_normal_equations(depth_image, sensor_image)
+
+    def _precompute_depth_alignment(self) -> TensorType["num_images", 2]:
+        """Fits the scale and offset aligning each monocular depth image to its sensor depth image.
+
+        This decodes every depth and sensor image once, and they are decoded again when a sample is first loaded:
+        keeping all of them in memory is what the sample cache is sized to avoid. With the persistent cache the fitted
+        alignment, the sensor images and the aligned depth images are stored, so later runs skip this step.
+        """
+        cache_path = None
+        if self._persistent_cache_dir is not None:
+            cache_path = self._persistent_cache_dir / "depth_align.npy"
+            if cache_path.exists():
+                return torch.from_numpy(np.load(cache_path))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_IO_THREADS) as executor:
+            systems = list(
+                track(
+                    executor.map(self._depth_alignment_system, range(len(self))),
+                    total=len(self),
+                    transient=True,
+                    description="Aligning depth images",
+                )
+            )
+        lhs = torch.stack([system[0] for system in systems])
+        rhs = torch.stack([system[1] for system in systems])
+        depth_align = _solve_depth_alignment(lhs, rhs)
+        if cache_path is not None:
+            _save_npy_atomic(cache_path, depth_align.numpy())
+        return depth_align
+
+    def _check_image_sizes(self) -> bool:
+        """Returns whether all images have the same height and width.
+
+        The result is cached in `cache_dir` (if set), keyed by the image filenames, so only the first run has to
+        touch every image. Image headers are read concurrently since the scan is I/O bound, and the images are
+        prefetched into the page cache on the way.
+        """
+        cache_path = None
+        if self.cache_dir is not None:
+            cache_path = Path(self.cache_dir) / f"hw_scan_{self._filenames_hash}.json"
+            if cache_path.exists():
+                return load_from_json(cache_path)["all_hw_same"]
+
+        filenames = self._dataparser_outputs.image_filenames
         all_hw_same = True
-        for filename in track(
-            self._dataparser_outputs.image_filenames, transient=True, description="Checking image sizes"
-        ):
-            image = Image.open(filename)
-            if h is None:
-                h = image.height
-                w = image.width
+        first_hw = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_IO_THREADS) as executor:
+            futures = [executor.submit(_probe_image_size, filename) for filename in filenames]
+            for future in track(
+                concurrent.futures.as_completed(futures),
+                total=len(futures),
+                transient=True,
+                description="Checking image sizes",
+            ):
+                hw = future.result()
+                if first_hw is None:
+                    first_hw = hw
+                if hw != first_hw:
+                    all_hw_same = False
+                    break
+            if not all_hw_same:
+                for future in futures:
+                    future.cancel()
 
-            if image.height != h or image.width != w:
-                all_hw_same = False
-                break
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            _write_json_atomic(cache_path, {"all_hw_same": all_hw_same})
+        return all_hw_same
 
-        self.all_hw_same = all_hw_same
+    def get_image(self, image_idx: int) -> TensorType["image_height", "image_width", "num_channels"]:
+        """Returns an image.  (could be 1 or 3 channel)
 
-        self.depth_unit_scale_factor = self.metadata.get("depth_unit_scale_factor", 0.)
+        JPEG images are decoded on the GPU if enabled, everything else (and rescaled images) goes through PIL.
+
+        Args:
+            image_idx: The image index in the dataset.
+        """
+        image_filename = Path(self._dataparser_outputs.image_filenames[image_idx])
+        if (
+            not self.decode_jpeg_on_gpu
+            or self.scale_factor != 1.0
+            or image_filename.suffix.lower() not in (".jpg", ".jpeg")
+        ):
+            return super().get_image(image_idx)
+        try:
+            image = _decode_jpeg_on_gpu(image_filename)
+        except RuntimeError as error:
+            # e.g. CMYK or progressive JPEGs that nvjpeg does not support, anything else (such as CUDA errors) is raised
+            if not _is_jpeg_decode_error(error):
+                raise
+            if not self._warned_jpeg_fallback:
+                self._warned_jpeg_fallback = True
+                CONSOLE.print(
+                    f"[bold yellow]Warning: could not decode {image_filename} on the GPU ({error}), "
+                    "falling back to PIL for such images."
+                )
+            return super().get_image(image_idx)
+        return image.float() / 255.0
 
     def get_data(self, image_idx: int) -> Dict:
         """Returns the ImageDataset data as a dictionary.
@@ -81,17 +460,20 @@ class GeneralizedDataset(InputDataset):
         #     return super().get_data(image_idx)
 
         # Otherwise return them in a custom struct
-        if image_idx in self.image_cache:
-            image = self.image_cache[image_idx]
-        else:
-            image = self.get_image(image_idx)
-            self.image_cache[image_idx] = image
-
         data = {"image_idx": image_idx}
-        data["is_gray"] = BasicImages([torch.ones_like(image[..., :1]) * image.shape[-1] == 1])
+        cached_data = self._get_cached_data(image_idx)
+        if cached_data is not None:
+            data.update(cached_data)
+            return data
+
+        image = self.get_image(image_idx)
+        height, width, num_channels = image.shape
+        # stride-0 views, neither the per-pixel gray flag nor the gray channels are materialized (both are read-only)
+        is_gray = torch.full((1, 1, 1), num_channels == 1, dtype=torch.bool)
+        data["is_gray"] = BasicImages([is_gray.expand(height, width, 1)])
         # data["is_gray"] = BasicImages([torch.zeros_like(image[..., :1])])  # uncomment to disable grayscale
-        if image.shape[-1] == 1:
-            image = image.tile(1, 1, 3)
+        if num_channels == 1:
+            image = image.expand(height, width, 3)
         data["image"] = BasicImages([image])
         for key, data_func_dict in self._dataparser_outputs.metadata.items():
             if isinstance(data_func_dict, dict) and "func" in data_func_dict:
@@ -100,20 +482,87 @@ class GeneralizedDataset(InputDataset):
                 data.update(func(image_idx, **data_func_dict["kwargs"]))
         if self.has_masks:
             mask_filepath = self._dataparser_outputs.mask_filenames[image_idx]
-            mask_image = get_image_mask_tensor_from_path(filepath=mask_filepath, scale_factor=self.scale_factor)
+            mask_image = self._load_cached_tensor(
+                "mask",
+                image_idx,
+                lambda: get_image_mask_tensor_from_path(filepath=mask_filepath, scale_factor=self.scale_factor),
+            )
             assert (
                     mask_image.shape[:2] == image.shape[:2]
             ), f"Mask and image have different shapes. Got {mask_image.shape[:2]} and {image.shape[:2]}"
 
-            # save nonzero_indices so that we only compute it once
-            nonzero_indices = torch.nonzero(mask_image[..., 0], as_tuple=False)
-            mask_tensor = nonzero_indices
+            # save the flat nonzero indices so that we only compute them once
+            mask_tensor = get_mask_indices(mask_image[..., 0])
             assert len(mask_tensor) > 0
             data["mask"] = BasicImages([mask_tensor])
         metadata = self.get_metadata(data)
         data.update(metadata)
+        self._cache_data(image_idx, data)
         return data
 
+    def _get_cached_data(self, image_idx: int) -> Optional[Dict]:
+        """Returns a shallow copy of the cached sample (without `image_idx`), or None on a cache miss."""
+        with self._data_cache_lock:
+            if image_idx not in self._data_cache:
+                return None
+            self._data_cache.move_to_end(image_idx)
+            return dict(self._data_cache[image_idx])
+
+    def _cache_data(self, image_idx: int, data: Dict) -> None:
+        """Stores a sample in the in-memory cache, evicting the least recently used samples if it is full."""
+        with self._data_cache_lock:
+            if self.cache_size is None:
+                self.cache_size = _reserve_data_cache_memory(_data_nbytes(data), len(self))
+            if self.cache_size <= 0:
+                return
+            self._data_cache[image_idx] = {key: value for key, value in data.items() if key != "image_idx"}
+            self._data_cache.move_to_end(image_idx)
+            while len(self._data_cache) > self.cache_size:
+                self._data_cache.popitem(last=False)
+
+    def clear_cache(self) -> None:
+        """Drops all samples from the in-memory cache."""
+        with self._data_cache_lock:
+            self._data_cache.clear()
+        self.image_cache.clear()
+
+    def get_collated_batch(self, indices: List[int], num_threads: int = NUM_IO_THREADS) -> Dict:
+        """Returns the data of several images, already collated into a single batch.
+
+        This gives the same result as `nerfstudio_collate` applied to the samples, except that images are stacked
+        into (B, H, W, C) tensors instead of being kept in `BasicImages` when all images have the same size and
+        every key of the samples can be stacked. Like the images of `nerfstudio_collate`, the stacked tensors are
+        meant to stay on the CPU, see `STACKABLE_IMAGE_KEYS`.
+
+        Args:
+            indices: The image indices in the dataset.
+            num_threads: Number of threads used to load the samples.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            samples = list(executor.map(self.get_data, indices))
+
+        values: Dict[str, List] = {}
+        for sample in samples:
+            for key, value in sample.items():
+                values.setdefault(key, []).append(value)
+
+        stack_images = self.all_hw_same and all(key in STACKABLE_IMAGE_KEYS or key == "image_idx" for key in values)
+        batch = {}
+        for key, key_values in values.items():
+            # e.g. foreground masks and sensor depths of the sdfstudio dataparser are plain tensors already, those are
+            # stacked by `nerfstudio_collate`
+            is_basic_images = all(isinstance(value, BasicImages) for value in key_values)
+            if stack_images and is_basic_images and key == "is_gray":
+                # the flag is constant per image, so the batch stays a stride-0 view as well
+                height, width, _ = key_values[0].images[0].shape
+                flags = torch.stack([value.images[0][:1, :1] for value in key_values])
+                batch[key] = flags.expand(len(key_values), height, width, 1)
+            elif stack_images and is_basic_images and key in STACKABLE_IMAGE_KEYS:
+                batch[key] = torch.stack([value.images[0] for value in key_values])
+            else:
+                batch[key] = nerfstudio_collate(key_values)
+        return batch
+
     def get_metadata(self, data: Dict) -> Dict:
         metadata = {}
 
@@ -121,42 +570,26 @@ class GeneralizedDataset(InputDataset):
         height, width, c = data["image"].images[0].shape
 
         if "depth_filenames" in self.metadata:
-            depth_filepath = self.metadata["depth_filenames"][image_idx]
-
-            # Scale depth images to meter units and also by scaling applied to cameras
-            scale_factor = self.depth_unit_scale_factor * self._dataparser_outputs.dataparser_scale
-            depth_image = get_depth_image_from_path(
-                filepath=depth_filepath, height=height, width=width, scale_factor=scale_factor
-            )
+            depth_image = self._load_aligned_depth_image(image_idx, height, width)
 
             metadata["depth_image"] = BasicImages([depth_image])  # [W, H, 1] ??
 
         if "sensor_filenames" in self.metadata:
-            sensor_filepath = self.metadata["sensor_filenames"][image_idx]
-
-            # Scale depth images to meter units and also by scaling applied to cameras
-            scale_factor = self.depth_unit_scale_factor
-            sensor_image = get_depth_image_from_path(
-                filepath=sensor_filepath, height=height, width=width, scale_factor=scale_factor
-            )
+            sensor_image = self._load_sensor_image(image_idx, height, width)
 
             metadata["sensor_depth"] = BasicImages([sensor_image])  # [W, H, 1] ??
 
-        if "sensor_filenames" in self.metadata and "depth_filenames" in self.metadata:
-            # scale depth
-            mask = (sensor_image > 0.0).squeeze()
-            # scale * depth_pred + offset * 1 - depth_gt = 0
-            D = torch.cat((depth_image[mask], torch.ones_like(depth_image[mask])), dim=1)
-            Sb = torch.linalg.lstsq(D, sensor_image[mask]).solution
-
-            metadata["depth_image"] = BasicImages([depth_image * Sb[0] + Sb[1]])  # [W, H, 1] ??
-
         if "normal_filenames" in self.metadata:
             normal_filepath = self.metadata["normal_filenames"][image_idx]
 
             camera_to_world = self._dataparser_outputs.cameras.camera_to_worlds[image_idx]
-            normal_image = get_normal_image_from_path(
-                filepath=normal_filepath, height=height, width=width, camera_to_world=camera_to_world
+            normal_image = self._load_cached_tensor(
+                "normal",
+                image_idx,
+                lambda: get_normal_image_from_path(
+                    filepath=normal_filepath, height=height, width=width, camera_to_world=camera_to_world
+                ),
+                encode_fn=quantize_normal_image,
             )
             metadata["normal_image"] = BasicImages([normal_image])
 
@@ -23,6 +23,7 @@ from typing import Dict, Optional, Union
 import torch
 from torchtyping import TensorType
 
+from nerfstudio.data.utils.data_utils import dequantize_images, unpack_mask_indices
 from nerfstudio.utils.images import BasicImages
 
 
@@ -65,10 +66,10 @@ class PixelSampler:  # pylint: disable=too-few-public-methods
             mask: mask of possible pixels in an image to sample from.
         """
         if isinstance(mask, torch.Tensor):
-            # nonzero_indices = torch.nonzero(mask[..., 0], as_tuple=False)  # todo assumes only nonzero indices are stored
+            # todo assumes only the flat nonzero indices are stored, see `get_mask_indices`
             nonzero_indices = mask
             chosen_indices = random.sample(range(len(nonzero_indices)), k=batch_size)
-            indices = nonzero_indices[chosen_indices]
+            indices = unpack_mask_indices(nonzero_indices[chosen_indices], image_width)
 
             indices = torch.cat([torch.full((batch_size, 1), -1, device=device), indices], dim=-1) # -1 must be overriden by image_idx
 
@@ -255,7 +256,8 @@ class PixelSampler:  # pylint: disable=too-few-public-methods
             )
         else:
             raise ValueError("image_batch['image'] must be a list or torch.Tensor")
-        return pixel_batch
+        # images may be stored compactly by the dataset, only the sampled pixels are converted back
+        return dequantize_images(pixel_batch)
 
 
 class EquirectangularPixelSampler(PixelSampler):  # pylint: disable=too-few-public-methods
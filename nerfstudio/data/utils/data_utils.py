@@ -14,7 +14,7 @@
 
 """Utility functions to allow easy re-use of common operations across dataloaders"""
 from pathlib import Path
-from typing import List, Tuple, Union
+from typing import Dict, List, Tuple, Union
 
 import cv2
 import numpy as np
@@ -23,6 +23,10 @@ from PIL import Image
 from torchtyping import TensorType
 
 from nerfstudio.data.utils import colmap_utils
+from nerfstudio.utils.images import BasicImages
+
+NORMAL_QUANTIZATION_SCALE = 127.0
+"""Normal images are stored as int8 with a resolution of 1 / NORMAL_QUANTIZATION_SCALE."""
 
 
 def get_image_mask_tensor_from_path(filepath: Path, scale_factor: float = 1.0) -> torch.Tensor:
@@ -48,6 +52,28 @@ def get_image_mask_tensor_from_path(filepath: Path, scale_factor: float = 1.0) -
     return mask_tensor
 
 
+def get_mask_indices(mask: TensorType["image_height", "image_width"]) -> TensorType["num_nonzero"]:
+    """Returns the flat indices (y * width + x) of the nonzero pixels of a mask as int32.
+
+    Stored this way, the indices take 4 bytes per pixel instead of the 16 bytes of `torch.nonzero`'s (N, 2) int64.
+
+    Args:
+        mask: Mask image.
+    """
+    return mask.reshape(-1).nonzero(as_tuple=True)[0].to(torch.int32)
+
+
+def unpack_mask_indices(indices: TensorType["num_indices"], width: int) -> TensorType["num_indices", 2]:
+    """Converts flat pixel indices produced by `get_mask_indices` to (y, x) coordinates.
+
+    Args:
+        indices: Flat pixel indices.
+        width: Width of the image the indices refer to.
+    """
+    indices = indices.long()
+    return torch.stack([indices // width, indices % width], dim=1)
+
+
 def get_semantics_and_mask_tensors_from_path(
     filepath: Path, mask_indices: Union[List, torch.Tensor], scale_factor: float = 1.0
 ) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -141,3 +167,46 @@ def get_normal_image_from_path(
     normal_map = rot @ normal_tr @ normal_map
     normal_map = normal_map.permute(1, 0).reshape(h, w, 3)
     return normal_map
+
+
+def quantize_normal_image(normal: torch.Tensor) -> torch.Tensor:
+    """Converts a normal image with values in [-1, 1] to int8, quartering its size.
+
+    Args:
+        normal: Normal image.
+
+    Returns:
+        int8 normal image, see `dequantize_normal_image` for the inverse.
+    """
+    return (normal.clamp(-1.0, 1.0) * NORMAL_QUANTIZATION_SCALE).round().to(torch.int8)
+
+
+def dequantize_normal_image(normal: torch.Tensor) -> torch.Tensor:
+    """Converts a normal image produced by `quantize_normal_image` back to float32.
+    Float normal images are returned unchanged.
+    """
+    if normal.dtype != torch.int8:
+        return normal
+    return normal.float() / NORMAL_QUANTIZATION_SCALE
+
+
+def dequantize_images(batch: Dict) -> Dict:
+    """Converts the compactly stored depth (float16) and normal (int8) images of a batch back to float32, in place.
+
+    Args:
+        batch: Batch of data, the images may be tensors or wrapped in `BasicImages`.
+
+    Returns:
+        The updated batch.
+    """
+    dequantize_fns = {
+        "depth_image": lambda depth: depth.float() if depth.dtype == torch.float16 else depth,
+        "normal_image": dequantize_normal_image,
+    }
+    for key, dequantize_fn in dequantize_fns.items():
+        value = batch.get(key)
+        if isinstance(value, BasicImages):
+            batch[key] = BasicImages([dequantize_fn(image) for image in value.images])
+        elif isinstance(value, torch.Tensor):
+            batch[key] = dequantize_fn(value)
+    return batch
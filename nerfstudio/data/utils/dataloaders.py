@@ -31,6 +31,8 @@ from torch.utils.data.dataloader import DataLoader
 from nerfstudio.cameras.cameras import Cameras
 from nerfstudio.cameras.rays import RayBundle
 from nerfstudio.data.datasets.base_dataset import InputDataset
+from nerfstudio.data.datasets.generalized_dataset import STACKABLE_IMAGE_KEYS
+from nerfstudio.data.utils.data_utils import dequantize_images
 from nerfstudio.data.utils.nerfstudio_collate import nerfstudio_collate
 from nerfstudio.utils.misc import get_dict_to_torch
 
@@ -91,18 +93,20 @@ class CacheDataloader(DataLoader):
     def __getitem__(self, idx):
         return self.dataset.__getitem__(idx)
 
-    def _get_batch_list(self):
+    def _get_num_threads(self) -> int:
+        """Returns the number of threads used to load a batch."""
+        num_threads = int(self.num_workers) * 4
+        num_threads = min(num_threads, multiprocessing.cpu_count() - 1)
+        num_threads = max(num_threads, 1)
+        return num_threads
+
+    def _get_batch_list(self, indices):
         """Returns a list of batches from the dataset attribute."""
 
-        indices = random.sample(range(len(self.dataset)), k=self.num_images_to_sample_from)
         batch_list = []
         results = []
 
-        num_threads = int(self.num_workers) * 4
-        num_threads = min(num_threads, multiprocessing.cpu_count() - 1)
-        num_threads = max(num_threads, 1)
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._get_num_threads()) as executor:
             for idx in indices:
                 res = executor.submit(self.dataset.__getitem__, idx)
                 results.append(res)
@@ -116,9 +120,16 @@ class CacheDataloader(DataLoader):
 
     def _get_collated_batch(self):
         """Returns a collated batch."""
-        batch_list = self._get_batch_list()
-        collated_batch = self.collate_fn(batch_list)
-        collated_batch = get_dict_to_torch(collated_batch, device=self.device, exclude=["image"])
+        indices = random.sample(range(len(self.dataset)), k=self.num_images_to_sample_from)
+        if self.collate_fn is nerfstudio_collate and hasattr(self.dataset, "get_collated_batch"):
+            # the dataset loads and collates the whole batch itself, possibly stacking same-sized images
+            collated_batch = self.dataset.get_collated_batch(indices, num_threads=self._get_num_threads())
+            exclude = list(STACKABLE_IMAGE_KEYS)
+        else:
+            batch_list = self._get_batch_list(indices)
+            collated_batch = self.collate_fn(batch_list)
+            exclude = ["image"]
+        collated_batch = get_dict_to_torch(collated_batch, device=self.device, exclude=exclude)
         return collated_batch
 
     def __iter__(self):
@@ -185,7 +196,7 @@ class EvalDataloader(DataLoader):
             image_idx: Camera image index
         """
         ray_bundle = self.cameras.generate_rays(camera_indices=image_idx, keep_shape=True)
-        batch = self.input_dataset[image_idx]
+        batch = dequantize_images(self.input_dataset[image_idx])
         batch = get_dict_to_torch(batch, device=self.device, exclude=["image"])
         return ray_bundle, batch
 
@@ -17,7 +17,17 @@ Input/output utils.
 """
 
 import json
+import os
+import pickle
+import threading
 from pathlib import Path
+from typing import Any, Callable, List
+
+import yaml
+
+# libyaml based loaders are much faster than the pure python ones, fall back to those if libyaml is missing
+YAML_LOADER = yaml.CLoader if yaml.__with_libyaml__ else yaml.Loader
+YAML_FULL_LOADER = yaml.CFullLoader if yaml.__with_libyaml__ else yaml.FullLoader
 
 
 def load_from_json(filename: Path):
@@ -41,3 +51,48 @@ def write_to_json(filename: Path, content: dict):
     assert filename.suffix == ".json"
     with open(filename, "w", encoding="UTF-8") as file:
         json.dump(content, file)
+
+
+def load_with_pickle_cache(cache_filename: Path, source_filenames: List[Path], load_fn: Callable[[], Any]) -> Any:
+    """Returns the result of `load_fn`, memoized in a pickle file.
+
+    The pickle is reused as long as it is newer than all of the source files, otherwise it is rewritten.
+
+    Args:
+        cache_filename: The pickle file to cache the result in.
+        source_filenames: The files `load_fn` reads from.
+        load_fn: Function loading the data from the source files.
+    """
+    if cache_filename.exists():
+        cache_mtime = cache_filename.stat().st_mtime
+        if all(filename.stat().st_mtime <= cache_mtime for filename in source_filenames):
+            try:
+                with open(cache_filename, "rb") as file:
+                    return pickle.load(file)
+            except Exception:  # pylint: disable=broad-except
+                pass  # truncated or otherwise unreadable pickle, treat it as a cache miss and rewrite it
+
+    content = load_fn()
+    # write to a temporary file first, so concurrent readers never see a partially written pickle
+    tmp_filename = cache_filename.with_name(f"{cache_filename.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_filename, "wb") as file:
+            pickle.dump(content, file)
+        os.replace(tmp_filename, cache_filename)
+    except OSError:
+        pass  # e.g. read-only dataset directory, just don't cache
+    return content
+
+
+def load_cached_yaml(filename: Path, loader=YAML_LOADER) -> Any:
+    """Load a YAML file, memoizing the parsed content in a pickle file next to it.
+
+    Args:
+        filename: The filename to load from.
+        loader: The yaml loader class to parse the file with.
+    """
+    return load_with_pickle_cache(
+        filename.with_name(f"{filename.name}.pkl"),
+        [filename],
+        lambda: yaml.load(filename.read_text(), Loader=loader),
+    )
@@ -2,36 +2,44 @@ import blenderproc as bproc
 
 import argparse
 
-import pandas as pd
-import yaml
-
 """
 Script to generate sky mask, depth and normal maps using blender
 Reads the colmap model and sets the camera
 """
 
-from typing import Optional
+from collections import defaultdict
+from typing import Dict, Optional
 from pathlib import Path
-import numpy as np
 import sys
 
-from PIL import Image
-from blenderproc.python.utility.Utility import UndoAfterExecution
-from blenderproc.scripts.saveAsImg import save_array_as_image
-from matplotlib import pyplot as plt, cm
+# heavy modules are imported where they are used, so that CLI errors are reported without loading them
 
 sdfstudio_dir = Path("./")
 
 sys.path.insert(0, str(sdfstudio_dir))
 
-from nerfstudio.data.utils.colmap_utils import read_cameras_binary, read_images_binary
-
 
 # import pydevd_pycharm
 
 # pydevd_pycharm.settrace("localhost", port=12345, stdoutToServer=True, stderrToServer=True)
 
 
+# uint8 lookup tables of the matplotlib colormaps, shape (256, 3), built on first use
+_LUT_CACHE: Dict[str, "np.ndarray"] = {}
+
+
+def get_colormap_lut(cmap: str) -> "np.ndarray":
+    """Returns the uint8 lookup table of a matplotlib colormap."""
+    import numpy as np
+    from matplotlib import pyplot as plt
+
+    lut = _LUT_CACHE.get(cmap)
+    if lut is None:
+        lut = (np.asarray(plt.colormaps[cmap].colors) * 255).astype(np.uint8)
+        _LUT_CACHE[cmap] = lut
+    return lut
+
+
 def apply_colormap(image, cmap="viridis"):
     """Convert single channel to a color image.
 
@@ -40,17 +48,17 @@ def apply_colormap(image, cmap="viridis"):
         cmap: Colormap for image.
 
     Returns:
-        TensorType: Colored image
+        Colored image (uint8)
     """
+    import numpy as np
 
-    colormap = plt.colormaps[cmap]
     image = np.nan_to_num(image, nan=0)
-    image_long = (255 * np.array(image)).astype("int")
+    image_long = (255 * image).astype("int")
     image_long_min = np.min(image_long)
     image_long_max = np.max(image_long)
     assert image_long_min >= 0, f"the min value is {image_long_min}"
     assert image_long_max <= 255, f"the max value is {image_long_max}"
-    return np.array(colormap.colors)[image_long]
+    return get_colormap_lut(cmap)[image_long]
 
 
 def apply_depth_colormap(
@@ -66,33 +74,58 @@ def apply_depth_colormap(
         cmap: Colormap to apply.
 
     Returns:
-        Colored depth image
+        Colored depth image (uint8)
     """
+    import numpy as np
 
     near_plane = near_plane or float(np.min(depth))
     print(f"Min plane", near_plane)
     far_plane = far_plane or float(np.max(depth))
 
-    depth = (depth - near_plane) / (far_plane - near_plane + 1e-10)
-    depth = np.clip(depth, 0, 1)
+    # quantize depth into the 256 colormap bins in one pass, values outside [near, far] end up in the first/last bin
+    bin_edges = np.linspace(near_plane, far_plane + 1e-10, 256)
+    depth = np.nan_to_num(depth, nan=near_plane)
+    binned = np.clip(np.digitize(depth, bin_edges) - 1, 0, 255)
 
-    colored_image = apply_colormap(depth, cmap=cmap)
+    colored_image = get_colormap_lut(cmap)[binned]
 
     if accumulation is not None:
-        colored_image = colored_image * accumulation + (1 - accumulation)
+        colored_image = np.where(accumulation, colored_image, np.uint8(255))
 
     return colored_image
 
 
-bproc.init()
-bproc.renderer.enable_depth_output(
-    activate_antialiasing=False,
-)
+def load_cached_colmap(data_path: Path):
+    """Reads the colmap cameras and images of a scene, memoized in a pickle file in the scene directory."""
+    from nerfstudio.data.utils.colmap_utils import read_cameras_binary, read_images_binary
+    from nerfstudio.utils.io import load_with_pickle_cache
 
-import bpy
+    cameras_path = data_path / "dense/sparse/cameras.bin"
+    images_path = data_path / "dense/sparse/images.bin"
+    return load_with_pickle_cache(
+        data_path / ".colmap_cache.pkl",
+        [cameras_path, images_path],
+        lambda: {"cameras": read_cameras_binary(str(cameras_path)), "images": read_images_binary(str(images_path))},
+    )
 
 
 def render_scene(scene_name, resolution: int):
+    import cv2
+    import numpy as np
+    import pandas as pd
+    from blenderproc.scripts.saveAsImg import save_array_as_image
+    from PIL import Image
+
+    from nerfstudio.utils.io import load_cached_yaml
+
+    bproc.init()
+    bproc.renderer.enable_depth_output(
+        activate_antialiasing=False,
+    )
+    bproc.renderer.enable_normals_output()
+
+    import bpy
+
     for training_path in (sdfstudio_dir / "outputs" / scene_name).rglob("./**/nerfstudio_models/"):
         print(training_path)
 
@@ -113,7 +146,7 @@ def render_scene(scene_name, resolution: int):
             continue
         render_dir.mkdir(exist_ok=True)
         config_file = ckpt_file.parent.with_name("config.yml")
-        config = yaml.load(config_file.read_text(), Loader=yaml.Loader)
+        config = load_cached_yaml(config_file)
 
         setting = config.pipeline.datamanager.dataparser.setting
         setting_suffix = "" if setting == "" else f"_{setting}"
@@ -139,18 +172,21 @@ def render_scene(scene_name, resolution: int):
         print("Loading pcd done")
 
         # load colmap cameras and visualize as spheres
-        camdata = read_cameras_binary(str(data_path / "dense/sparse/cameras.bin"))
-        imdata = read_images_binary(str(data_path / "dense/sparse/images.bin"))
+        colmap = load_cached_colmap(data_path)
+        camdata = colmap["cameras"]
+        imdata = colmap["images"]
 
         bottom = np.array([0, 0, 0, 1.0]).reshape(1, 4)
 
         # load tsv with test set
 
+        # group the test frames by camera, the frames of a camera share the intrinsics and are rendered
+        # in a single call as keyframes of one animated camera
+        frames_per_camera = defaultdict(list)
         for v in imdata.values():
             filename = v.name
             if filename not in file_list:
                 continue
-            print(filename)
 
             R = v.qvec2rotmat()
             t = v.tvec.reshape(3, 1)
@@ -158,10 +194,11 @@ def render_scene(scene_name, resolution: int):
             pose = np.linalg.inv(w2c)
             # pose[:3, 3:4] *= multiplier
             pose = bproc.math.change_source_coordinate_frame_of_transformation_matrix(pose, ["X", "-Y", "-Z"])
+            frames_per_camera[v.camera_id].append((filename, pose))
 
-            img_id = v.id
-            cam_id = v.camera_id
-
+        # reused across frames to store the sky mask, reallocated only when the camera resolution changes
+        mask_buf = None
+        for cam_id, frames in frames_per_camera.items():
             cam = camdata[cam_id]
 
             fx = cam.params[0]
@@ -170,26 +207,25 @@ def render_scene(scene_name, resolution: int):
             cy = cam.params[3]
 
             bproc.utility.reset_keyframes()
-            with UndoAfterExecution():
-                #            if True:
-                # define the camera resolution
-                K = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
-                bproc.camera.set_intrinsics_from_K_matrix(K, cam.width, cam.height)
-                bproc.camera.add_camera_pose(pose)
-
-                bproc.renderer.enable_normals_output()
-
-                data = bproc.renderer.render(
-                    load_keys={
-                        "distance",
-                        "depth",
-                        "normals",
-                    },
-                    output_key="colors",
-                )
-                print(data.keys())
-
-                depth_map = data["depth"][0]
+            # define the camera resolution
+            K = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]])
+            bproc.camera.set_intrinsics_from_K_matrix(K, cam.width, cam.height)
+            for frame, (_, pose) in enumerate(frames):
+                bproc.camera.add_camera_pose(pose, frame=frame)
+
+            data = bproc.renderer.render(
+                load_keys={
+                    "distance",
+                    "depth",
+                    "normals",
+                },
+                output_key="colors",
+            )
+            print(data.keys())
+
+            for frame, (filename, _) in enumerate(frames):
+                print(filename)
+                depth_map = data["depth"][frame]
                 sky_mask = depth_map != 1e10
                 # depth_map[sky_mask] /= multiplier
                 if depth_map[sky_mask].any():
@@ -198,21 +234,23 @@ def render_scene(scene_name, resolution: int):
                     continue
                 print(max_depth)
 
-                plt.imsave(
-                    str(render_dir / f"{filename}_depth.png"),
-                    apply_depth_colormap(data["depth"][0], far_plane=max_depth, accumulation=np.expand_dims(sky_mask, -1)),
+                colored_depth = apply_depth_colormap(
+                    depth_map, far_plane=max_depth, accumulation=np.expand_dims(sky_mask, -1)
                 )
-                plt.close()
+                cv2.imwrite(str(render_dir / f"{filename}_depth.png"), cv2.cvtColor(colored_depth, cv2.COLOR_RGB2BGR))
 
-                mask = Image.frombytes(mode="1", size=sky_mask.shape[::-1], data=np.packbits(sky_mask, axis=1))
+                if mask_buf is None or mask_buf.shape != sky_mask.shape:
+                    mask_buf = np.empty(sky_mask.shape, dtype=np.uint8)
+                np.multiply(sky_mask, np.uint8(255), out=mask_buf, dtype=np.uint8)
+                mask = Image.frombuffer("L", sky_mask.shape[::-1], mask_buf, "raw", "L", 0, 1)  # no copy
                 mask.save(str(render_dir / f"{filename}_mask.png"))
 
-                normals = data["normals"][0].clip(0, 1)
+                normals = data["normals"][frame].clip(0, 1)
                 normals[~sky_mask] = 1  # bg to white
                 save_array_as_image(normals, "normals", str(render_dir / f"{filename}_normals.png"))
-                save_array_as_image(data["colors"][0], "colors", str(render_dir / f"{filename}_color.png"))
+                save_array_as_image(data["colors"][frame], "colors", str(render_dir / f"{filename}_color.png"))
 
-                # np.save(str(render_dir / f"{filename}_depth.npy"), data["depth"][0])
+                # np.save(str(render_dir / f"{filename}_depth.npy"), data["depth"][frame])
 
 
 if __name__ == "__main__":
@@ -1,21 +1,14 @@
 import os
 
+import pandas as pd
+
 dataset_name = "semperoper"
 path = f"/media/dawars/Ventoy/dresden/{dataset_name}"
 images = f"{path}/dense/images"
 out_path = f"{path}/{dataset_name}.tsv"
 
-db = []
-
-header = ["filename", "id", "split", "dataset"]
-
-for image in os.listdir(images):
-    db.append([image, "-1", "train", dataset_name])
-
-with open(out_path, "w") as f:
-    f.write("\t".join(header))
-    f.write("\n")
+with os.scandir(images) as entries:
+    filenames = [entry.name for entry in entries if entry.is_file()]
 
-    for data in db:
-        f.write("\t".join(data))
-        f.write("\n")
+db = pd.DataFrame({"filename": filenames, "id": -1, "split": "train", "dataset": dataset_name})
+db.to_csv(out_path, sep="\t", index=False)
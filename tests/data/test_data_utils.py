@@ -0,0 +1,31 @@
+"""
+Test data utils
+"""
+
+import torch
+
+from nerfstudio.data.utils.data_utils import (
+    dequantize_normal_image,
+    get_mask_indices,
+    quantize_normal_image,
+    unpack_mask_indices,
+)
+
+
+def test_mask_indices():
+    """Test that flat mask indices unpack to the same coordinates as torch.nonzero."""
+    mask = torch.rand((7, 5)) > 0.5
+    indices = get_mask_indices(mask)
+
+    assert indices.dtype == torch.int32
+    assert torch.equal(unpack_mask_indices(indices, width=5), torch.nonzero(mask, as_tuple=False))
+
+
+def test_normal_quantization():
+    """Test int8 round trip of normal images."""
+    normal = torch.nn.functional.normalize(torch.randn((4, 6, 3)), dim=-1)
+    quantized = quantize_normal_image(normal)
+
+    assert quantized.dtype == torch.int8
+    assert torch.allclose(dequantize_normal_image(quantized), normal, atol=0.5 / 127 + 1e-6)
+    assert dequantize_normal_image(normal) is normal
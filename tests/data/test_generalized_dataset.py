@@ -0,0 +1,266 @@
+"""
+Test the generalized dataset
+"""
+import dataclasses
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from nerfstudio.cameras.cameras import Cameras
+from nerfstudio.data.dataparsers.base_dataparser import DataparserOutputs
+from nerfstudio.data.dataparsers.sdfstudio_dataparser import get_foreground_masks, get_sensor_depths
+from nerfstudio.data.datasets import generalized_dataset
+from nerfstudio.data.datasets.generalized_dataset import (
+    GeneralizedDataset,
+    _data_nbytes,
+    _decode_jpeg_on_gpu,
+    _depth_alignment_normal_equations,
+    _is_jpeg_decode_error,
+    _solve_depth_alignment,
+)
+from nerfstudio.data.utils.data_utils import get_image_mask_tensor_from_path
+from nerfstudio.data.utils.nerfstudio_collate import nerfstudio_collate
+from nerfstudio.utils.images import BasicImages
+
+HEIGHT = 6
+WIDTH = 8
+
+
+def _make_dataset(tmp_path, num_images=3, with_masks=False, metadata=None, **kwargs):
+    """Writes random images (and masks) to `tmp_path` and returns a dataset reading them."""
+    image_filenames = []
+    mask_filenames = []
+    for i in range(num_images):
+        image_filename = tmp_path / f"image_{i}.png"
+        Image.fromarray(np.random.randint(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8)).save(image_filename)
+        image_filenames.append(image_filename)
+        mask_filename = tmp_path / f"mask_{i}.png"
+        mask = np.random.randint(0, 2, (HEIGHT, WIDTH), dtype=np.uint8) * 255
+        Image.fromarray(mask).save(mask_filename)
+        mask_filenames.append(mask_filename)
+    cameras = Cameras(
+        camera_to_worlds=torch.eye(4)[None, :3, :].repeat(num_images, 1, 1),
+        fx=1.0,
+        fy=1.0,
+        cx=WIDTH / 2.0,
+        cy=HEIGHT / 2.0,
+        width=WIDTH,
+        height=HEIGHT,
+    )
+    dataparser_outputs = DataparserOutputs(
+        image_filenames=image_filenames,
+        cameras=cameras,
+        mask_filenames=mask_filenames if with_masks else None,
+        metadata=metadata or {},
+    )
+    return GeneralizedDataset(dataparser_outputs, decode_jpeg_on_gpu=False, **kwargs)
+
+
+def test_image_size_scan_cache(tmp_path, monkeypatch):
+    """Test that the image size scan is cached in `cache_dir`, so warm runs do not open the images."""
+    probed = []
+    probe_image_size = generalized_dataset._probe_image_size  # pylint: disable=protected-access
+    monkeypatch.setattr(
+        generalized_dataset, "_probe_image_size", lambda filename: probed.append(filename) or probe_image_size(filename)
+    )
+
+    dataset = _make_dataset(tmp_path, cache_dir=tmp_path / "cache")
+    dataparser_outputs = dataset._dataparser_outputs  # pylint: disable=protected-access
+    assert dataset.all_hw_same
+    assert len(probed) == 3
+
+    probed.clear()
+    dataset = GeneralizedDataset(dataparser_outputs, cache_dir=tmp_path / "cache", decode_jpeg_on_gpu=False)
+    assert dataset.all_hw_same
+    assert not probed
+
+    # mixed image sizes
+    Image.fromarray(np.zeros((HEIGHT + 1, WIDTH, 3), dtype=np.uint8)).save(dataparser_outputs.image_filenames[2])
+    dataset = GeneralizedDataset(dataparser_outputs, cache_dir=tmp_path / "mixed_cache", decode_jpeg_on_gpu=False)
+    assert not dataset.all_hw_same
+    assert probed
+
+    probed.clear()
+    dataset = GeneralizedDataset(dataparser_outputs, cache_dir=tmp_path / "mixed_cache", decode_jpeg_on_gpu=False)
+    assert not dataset.all_hw_same
+    assert not probed
+
+
+def test_data_cache(tmp_path):
+    """Test LRU eviction of the in-memory sample cache."""
+    dataset = _make_dataset(tmp_path, cache_size=2)
+
+    image = dataset.get_data(0)["image"].images[0]
+    dataset.get_data(1)
+    assert list(dataset._data_cache) == [0, 1]  # pylint: disable=protected-access
+
+    # a hit moves the sample to the end, so the least recently used sample 1 is evicted next
+    assert dataset.get_data(0)["image"].images[0] is image
+    dataset.get_data(2)
+    assert list(dataset._data_cache) == [0, 2]  # pylint: disable=protected-access
+
+    dataset.clear_cache()
+    assert len(dataset._data_cache) == 0  # pylint: disable=protected-access
+    assert dataset.get_data(0)["image"].images[0] is not image
+
+
+def test_data_cache_disabled(tmp_path):
+    """Test that a cache size of 0 disables the sample cache."""
+    dataset = _make_dataset(tmp_path, cache_size=0)
+
+    dataset.get_data(0)
+    assert len(dataset._data_cache) == 0  # pylint: disable=protected-access
+
+
+def test_data_nbytes(tmp_path):
+    """Test that the sample size counts shared and memory-mapped storages correctly."""
+    dataset = _make_dataset(tmp_path, cache_dir=tmp_path / "cache", persistent_cache=True)
+    depth = torch.ones((HEIGHT, WIDTH, 1), dtype=torch.float16)
+    dataset._load_cached_tensor("depth", 0, lambda: depth)  # pylint: disable=protected-access
+    mapped_depth = dataset._load_cached_tensor("depth", 0, lambda: depth)  # pylint: disable=protected-access
+
+    image = torch.rand((HEIGHT, WIDTH, 1))
+    data = {
+        "image_idx": 0,
+        "image": BasicImages([image.expand(HEIGHT, WIDTH, 3)]),
+        "is_gray": BasicImages([torch.ones((1, 1, 1), dtype=torch.bool).expand(HEIGHT, WIDTH, 1)]),
+        "depth_image": BasicImages([mapped_depth]),
+    }
+    assert _data_nbytes(data) == image.element_size() * image.numel() + 1
+
+    data["depth_image"] = BasicImages([depth])
+    assert _data_nbytes(data) == image.element_size() * image.numel() + 1 + depth.element_size() * depth.numel()
+
+
+def test_depth_alignment():
+    """Test that solving the normal equations matches the full least squares fit of depth to sensor depth."""
+    depth = torch.rand((HEIGHT, WIDTH, 1)) * 5.0
+    sensor_depth = 2.0 * depth + 0.5 + 0.1 * torch.randn((HEIGHT, WIDTH, 1))
+    sensor_depth[torch.rand((HEIGHT, WIDTH, 1)) > 0.7] = 0.0
+
+    lhs, rhs = _depth_alignment_normal_equations(depth, sensor_depth)
+    scale_offset = _solve_depth_alignment(lhs[None], rhs[None])[0]
+
+    mask = (sensor_depth > 0.0).squeeze(-1)
+    design = torch.stack([depth[mask, 0], torch.ones_like(depth[mask, 0])], dim=-1).double()
+    expected = torch.linalg.lstsq(design, sensor_depth[mask].double()).solution[:, 0]
+    assert torch.allclose(scale_offset, expected)
+
+
+def test_persistent_cache(tmp_path, monkeypatch):
+    """Test that cached tensors are memory-mapped on later accesses and keyed by what they depend on."""
+    cache_dir = tmp_path / "cache"
+    dataset = _make_dataset(tmp_path, with_masks=True, cache_dir=cache_dir, persistent_cache=True, cache_size=0)
+    mask = get_image_mask_tensor_from_path(tmp_path / "mask_0.png")
+
+    first = dataset._load_cached_tensor("mask", 0, lambda: mask)  # pylint: disable=protected-access
+    assert first is mask
+
+    load_calls = []
+    np_load = np.load
+    monkeypatch.setattr(np, "load", lambda *args, **kwargs: load_calls.append(kwargs) or np_load(*args, **kwargs))
+
+    def decode_again():
+        raise AssertionError("the mask should not be decoded again")
+
+    second = dataset._load_cached_tensor("mask", 0, decode_again)  # pylint: disable=protected-access
+    assert load_calls == [{"mmap_mode": "c"}]
+    assert torch.equal(second, first)
+    monkeypatch.undo()
+
+    cache_key_dir = dataset._persistent_cache_dir  # pylint: disable=protected-access
+    dataparser_outputs = dataset._dataparser_outputs  # pylint: disable=protected-access
+
+    def make_dataset(dataparser_outputs, **kwargs):
+        return GeneralizedDataset(
+            dataparser_outputs, cache_dir=cache_dir, persistent_cache=True, decode_jpeg_on_gpu=False, **kwargs
+        )
+
+    assert make_dataset(dataparser_outputs)._persistent_cache_dir == cache_key_dir  # pylint: disable=protected-access
+    rescaled = make_dataset(dataparser_outputs, scale_factor=0.5)
+    assert rescaled._persistent_cache_dir != cache_key_dir  # pylint: disable=protected-access
+
+    cameras = dataparser_outputs.cameras
+    camera_to_worlds = cameras.camera_to_worlds.clone()
+    camera_to_worlds[0, :, 3] = 1.0
+    moved_cameras = Cameras(camera_to_worlds, cameras.fx, cameras.fy, cameras.cx, cameras.cy, WIDTH, HEIGHT)
+    moved = make_dataset(dataclasses.replace(dataparser_outputs, cameras=moved_cameras))
+    assert moved._persistent_cache_dir != cache_key_dir  # pylint: disable=protected-access
+
+    # the masks are sources of the cached tensors as well
+    mask_filename = tmp_path / "mask_0.png"
+    os.utime(mask_filename, ns=(mask_filename.stat().st_atime_ns, mask_filename.stat().st_mtime_ns + 10**9))
+    assert make_dataset(dataparser_outputs)._persistent_cache_dir != cache_key_dir  # pylint: disable=protected-access
+
+    assert list(cache_dir.glob("hw_scan_*.json"))
+    assert not list(cache_dir.glob("*.tmp*"))
+
+
+def _flatten(value):
+    """Returns the values of a collated tensor or `BasicImages` as a flat tensor."""
+    if isinstance(value, BasicImages):
+        return torch.cat([image.flatten() for image in value.images])
+    return value.flatten()
+
+
+def test_collated_batch(tmp_path):
+    """Test that the batched loading gives the same values as collating the samples."""
+    metadata = {
+        "sensor_depth": {"func": get_sensor_depths, "kwargs": {"sensor_depths": torch.rand((3, HEIGHT, WIDTH, 1))}},
+        "foreground_masks": {
+            "func": get_foreground_masks,
+            "kwargs": {"fg_masks": torch.rand((3, HEIGHT, WIDTH, 1)) > 0.5},
+        },
+    }
+    # the ragged mask indices prevent stacking the images
+    for with_masks in (False, True):
+        dataset = _make_dataset(tmp_path, with_masks=with_masks, metadata=metadata, cache_size=0)
+        batch = dataset.get_collated_batch([2, 0])
+        expected = nerfstudio_collate([dataset.get_data(2), dataset.get_data(0)])
+
+        assert isinstance(batch["image"], torch.Tensor) != with_masks
+        assert batch.keys() == expected.keys()
+        for key, value in batch.items():
+            assert torch.equal(_flatten(value), _flatten(expected[key])), key
+
+
+def test_jpeg_decode_error():
+    """Test which errors of the GPU JPEG decoder fall back to PIL."""
+    # messages of torchvision's nvjpeg based decoder
+    assert _is_jpeg_decode_error(RuntimeError("nvjpegGetImageInfo failed: 2"))
+    assert _is_jpeg_decode_error(RuntimeError("Unknown NVJPEG chroma subsampling"))
+    assert _is_jpeg_decode_error(RuntimeError("The provided mode is not supported for JPEG decoding on GPU"))
+    # CUDA errors are raised
+    assert not _is_jpeg_decode_error(RuntimeError("CUDA error: an illegal memory access was encountered"))
+    assert not _is_jpeg_decode_error(RuntimeError("CUDA out of memory. Tried to allocate 2.00 MiB"))
+
+
+def test_jpeg_decode_fallback(tmp_path):
+    """Test that CMYK and progressive JPEGs either decode on the GPU or fall back to PIL."""
+    if not torch.cuda.is_available():
+        print("Unable to test GPU JPEG decoding without GPU.")
+        return
+
+    # smooth, since the chroma upsampling of nvjpeg and libjpeg differ on high frequencies
+    x, y = np.meshgrid(np.linspace(0, 255, WIDTH), np.linspace(0, 255, HEIGHT))
+    rgb = np.stack([x, y, np.full((HEIGHT, WIDTH), 128.0)], axis=-1).astype(np.uint8)
+    image_filenames = [tmp_path / "cmyk.jpg", tmp_path / "progressive.jpg"]
+    Image.fromarray(rgb).convert("CMYK").save(image_filenames[0])
+    Image.fromarray(rgb).save(image_filenames[1], progressive=True)
+    for image_filename in image_filenames:
+        try:
+            _decode_jpeg_on_gpu(image_filename)
+        except RuntimeError as error:
+            assert _is_jpeg_decode_error(error), str(error)
+
+    dataset = _make_dataset(tmp_path, num_images=2)
+    dataparser_outputs = dataclasses.replace(
+        dataset._dataparser_outputs, image_filenames=image_filenames  # pylint: disable=protected-access
+    )
+    gpu_dataset = GeneralizedDataset(dataparser_outputs, decode_jpeg_on_gpu=True)
+    pil_dataset = GeneralizedDataset(dataparser_outputs, decode_jpeg_on_gpu=False)
+    for image_idx in range(len(image_filenames)):
+        difference = gpu_dataset.get_image(image_idx) - pil_dataset.get_image(image_idx)
+        assert difference.abs().mean() < 2 / 255